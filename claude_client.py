@@ -3,36 +3,624 @@ Claude API Client for LuxAI
 A wrapper around Anthropic's Claude API for easy integration.
 """
 
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+import math
 import os
-from typing import Optional, Dict, List, Any
-from anthropic import Anthropic
+import random
+import sys
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque
+from types import MappingProxyType
+from typing import (
+    TYPE_CHECKING, Optional, Dict, List, Any, AsyncIterator, Callable, Deque,
+    FrozenSet, Iterator, Mapping, Sequence, Tuple, TextIO, Type,
+)
+
+from claude_stream import coalesce
+
+if TYPE_CHECKING:
+    from anthropic import Anthropic, AsyncAnthropic
+
+# The Anthropic SDK (and httpx/pydantic behind it) is imported on first use
+# rather than at module load, so importing this module stays cheap for
+# scripts that never create a client.
+
+logger = logging.getLogger(__name__)
+
+EPHEMERAL_CACHE = {"type": "ephemeral"}
+
+# Connection pool sized for concurrent use (e.g. achat_batch fan-out). HTTP/2
+# lets many requests and streams share a single keep-alive connection.
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 50
+HTTP_MAX_CONNECTIONS = 100
+HTTP_KEEPALIVE_EXPIRY = 60.0
+# Fail fast on connect; the read timeout matches the SDK default so long
+# non-streaming generations aren't cut off.
+HTTP_CONNECT_TIMEOUT = 5.0
+HTTP_READ_TIMEOUT = 600.0
+HTTP_CONNECT_RETRIES = 2
+
+# Upper bound for exponential backoff between retries and batch polls.
+MAX_BACKOFF = 60.0
+
+# Model, output budget and sampling temperature chosen together by the
+# preset argument. Explicit model/max_tokens/temperature arguments override
+# the preset; "balanced" is used when neither is given.
+PRESETS: Dict[str, Dict[str, Any]] = {
+    "fast": {"model": "claude-3-5-haiku-20241022", "max_tokens": 512, "temperature": 0.3},
+    "balanced": {"model": "claude-3-5-sonnet-20241022", "max_tokens": 1024, "temperature": 1.0},
+    "quality": {"model": "claude-3-5-sonnet-20241022", "max_tokens": 4096, "temperature": 1.0},
+}
+DEFAULT_PRESET = "balanced"
+
+# Cheap model used to summarize the middle of long conversations.
+SUMMARY_MODEL = "claude-3-5-haiku-20241022"
+
+# SDK clients shared by every ClaudeClient with the same API key, so they
+# reuse one HTTP connection pool instead of each opening new connections.
+# Async clients are additionally keyed by event loop: their pooled
+# connections are bound to the loop that opened them and can't be reused
+# after it closes (e.g. across separate asyncio.run() calls).
+# Retrying is handled by ClaudeClient._call_with_retry, so the SDK's own
+# retries are disabled to avoid multiplying attempts.
+_CLIENT_CACHE: Dict[str, "Anthropic"] = {}
+_ASYNC_CLIENT_CACHE: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, AsyncAnthropic]]" = (
+    weakref.WeakKeyDictionary()
+)
+# Token budgets, one per API key: rate limits apply per key, not per client.
+_BUDGETS: Dict[str, "_Budget"] = {}
+
+
+def _http_options() -> Dict[str, Any]:
+    """Build the httpx pool limits and timeout shared by the SDK clients."""
+    import httpx
+    
+    return {
+        "limits": httpx.Limits(
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            max_connections=HTTP_MAX_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        "timeout": httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+    }
+
+
+def _shared_client(api_key: str) -> "Anthropic":
+    """Return the process-wide Anthropic client for an API key."""
+    client = _CLIENT_CACHE.get(api_key)
+    if client is None:
+        import httpx
+        from anthropic import Anthropic
+        
+        options = _http_options()
+        http_client = httpx.Client(
+            transport=httpx.HTTPTransport(
+                http2=True, limits=options["limits"], retries=HTTP_CONNECT_RETRIES
+            ),
+            timeout=options["timeout"],
+        )
+        client = _CLIENT_CACHE[api_key] = Anthropic(
+            api_key=api_key, http_client=http_client, max_retries=0
+        )
+    return client
+
+
+def _shared_async_client(api_key: str) -> "AsyncAnthropic":
+    """Return the AsyncAnthropic client for an API key on the running event loop."""
+    loop = asyncio.get_running_loop()
+    for stale in [other for other in _ASYNC_CLIENT_CACHE if other.is_closed()]:
+        del _ASYNC_CLIENT_CACHE[stale]
+    clients = _ASYNC_CLIENT_CACHE.setdefault(loop, {})
+    client = clients.get(api_key)
+    if client is None:
+        import httpx
+        from anthropic import AsyncAnthropic
+        
+        options = _http_options()
+        http_client = httpx.AsyncClient(
+            transport=httpx.AsyncHTTPTransport(
+                http2=True, limits=options["limits"], retries=HTTP_CONNECT_RETRIES
+            ),
+            timeout=options["timeout"],
+        )
+        client = clients[api_key] = AsyncAnthropic(
+            api_key=api_key, http_client=http_client, max_retries=0
+        )
+    return client
+
+
+def _retryable_errors() -> Tuple[Type[Exception], ...]:
+    """SDK exception types that _retry_delay() knows how to classify."""
+    import anthropic
+    
+    return (anthropic.APIStatusError, anthropic.APIConnectionError)
+
+
+def _system_param(system_prompt: str, cache_system: bool) -> Any:
+    """Build the system parameter, marked for prompt caching if requested."""
+    if not cache_system:
+        return system_prompt
+    return [{"type": "text", "text": system_prompt, "cache_control": EPHEMERAL_CACHE}]
+
+
+@functools.lru_cache(maxsize=256)
+def _base_params(
+    message: str,
+    system_prompt: Optional[str],
+    max_tokens: int,
+    temperature: float,
+    cache_system: bool,
+    extra: FrozenSet[Tuple[str, Any]],
+) -> Mapping[str, Any]:
+    """
+    Build the model-independent part of a single-message request.
+    
+    Memoized so repeated calls, such as sweeping one prompt across several
+    models, reuse the same read-only payload instead of rebuilding it.
+    """
+    params = {
+        "messages": ({"role": "user", "content": message},),
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        **dict(extra),
+    }
+    if system_prompt:
+        params["system"] = _system_param(system_prompt, cache_system)
+    return MappingProxyType(params)
+
+
+def _cache_history(messages: Sequence[Mapping[str, Any]]) -> Sequence[Mapping[str, Any]]:
+    """
+    Mark the last assistant turn for prompt caching.
+    
+    Everything up to and including that turn is the stable prefix shared
+    with the next request, so caching it avoids re-processing the whole
+    history on every call. The caller's list is left untouched.
+    """
+    for i in range(len(messages) - 1, -1, -1):
+        if messages[i]["role"] != "assistant":
+            continue
+        content = messages[i]["content"]
+        blocks: List[Dict[str, Any]]
+        if isinstance(content, str):
+            blocks = [{"type": "text", "text": content}]
+        else:
+            blocks = [dict(block) for block in content]
+        if not blocks:
+            break
+        blocks[-1]["cache_control"] = EPHEMERAL_CACHE
+        cached = list(messages)
+        cached[i] = {**messages[i], "content": blocks}
+        return cached
+    return messages
+
+
+def _log_cache_usage(response: Any) -> None:
+    """Log prompt-cache hits and writes reported by the API."""
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return
+    logger.debug(
+        "prompt cache: read=%s created=%s input=%s",
+        getattr(usage, "cache_read_input_tokens", None),
+        getattr(usage, "cache_creation_input_tokens", None),
+        usage.input_tokens,
+    )
+
+
+def _retry_delay(error: Exception, attempt: int) -> Optional[float]:
+    """
+    Work out how long to wait before retrying a failed request.
+    
+    Rate limits (429), server errors (5xx) and connection failures are
+    retryable. The server's Retry-After header is honored when present,
+    otherwise the delay grows exponentially; a little jitter is added so
+    concurrent callers don't retry in lockstep.
+    
+    Returns:
+        Seconds to sleep, or None if the error shouldn't be retried
+    """
+    import anthropic
+    
+    delay: Optional[float] = None
+    if isinstance(error, anthropic.APIStatusError):
+        if not isinstance(error, anthropic.RateLimitError) and error.status_code < 500:
+            return None
+        try:
+            delay = float(error.response.headers.get("retry-after"))
+        except (TypeError, ValueError):
+            pass
+    elif not isinstance(error, anthropic.APIConnectionError):
+        return None
+    if delay is None:
+        delay = min(2.0 ** attempt, MAX_BACKOFF)
+    return delay + random.random() * 0.25
+
+
+def _estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token), without an API call."""
+    return len(text) // 4
+
+
+def _content_text(content: Any) -> str:
+    """Flatten string or block content, including tool calls and tool results."""
+    if content is None:
+        return ""
+    if isinstance(content, str):
+        return content
+    parts = []
+    for block in content:
+        if not isinstance(block, Mapping):
+            continue
+        kind = block.get("type")
+        if kind == "tool_use":
+            # default=dict handles inputs frozen by Conversation.
+            arguments = json.dumps(block.get("input"), default=dict)
+            parts.append(f"{block.get('name')}({arguments})")
+        elif kind == "tool_result":
+            parts.append(_content_text(block.get("content")))
+        else:
+            parts.append(block.get("text", ""))
+    return "\n".join(part for part in parts if part)
+
+
+def _message_text(message: Mapping[str, Any]) -> str:
+    """Get the text of a message whose content is a string or content blocks."""
+    return _content_text(message["content"])
+
+
+def _has_tool_result(message: Mapping[str, Any]) -> bool:
+    """Check whether a message answers a tool_use from the previous turn."""
+    content = message["content"]
+    return not isinstance(content, str) and any(
+        isinstance(block, Mapping) and block.get("type") == "tool_result"
+        for block in content
+    )
+
+
+def _estimate_request_tokens(params: Mapping[str, Any]) -> int:
+    """Upper-bound estimate of the tokens a request will consume."""
+    tokens = sum(_estimate_tokens(_message_text(m)) for m in params["messages"])
+    system = params.get("system")
+    if system:
+        tokens += _estimate_tokens(_message_text({"content": system}))
+    return tokens + params["max_tokens"]
+
+
+def _resolve_preset(
+    preset: Optional[str],
+    model: Optional[str],
+    max_tokens: Optional[int],
+    temperature: Optional[float],
+) -> Tuple[str, int, float]:
+    """Fill in model, max_tokens and temperature from a preset where not given."""
+    name = preset or DEFAULT_PRESET
+    try:
+        defaults = PRESETS[name]
+    except KeyError:
+        raise ValueError(
+            f"Unknown preset {name!r}. Choose from: {', '.join(PRESETS)}"
+        ) from None
+    return (
+        model if model is not None else defaults["model"],
+        max_tokens if max_tokens is not None else defaults["max_tokens"],
+        temperature if temperature is not None else defaults["temperature"],
+    )
+
+
+def _require_message(message: str) -> None:
+    """Reject empty prompts locally instead of paying for a round trip."""
+    if not message or not message.strip():
+        raise ValueError("Message must not be empty.")
+
+
+def _has_content(message: Mapping[str, Any]) -> bool:
+    """Check a message for non-blank text or any non-text block (image, tool result)."""
+    content = message["content"]
+    if isinstance(content, str):
+        return bool(content.strip())
+    return any(
+        not isinstance(block, Mapping)
+        or block.get("type") != "text"
+        or block.get("text", "").strip()
+        for block in content
+    )
+
+
+def _require_history(messages: Sequence[Mapping[str, Any]]) -> None:
+    """Require at least one non-empty user turn."""
+    if not any(m["role"] == "user" and _has_content(m) for m in messages):
+        raise ValueError("Conversation must contain a non-empty user message.")
+
+
+class _Budget:
+    """
+    Rolling 60-second token budget for pacing requests under a TPM limit.
+    
+    Each request reserves its estimated size before it is sent, so
+    concurrent callers see each other's usage, and the reservation is
+    corrected to the real usage once the response arrives. A request that
+    doesn't fit waits for the window to drain instead of drawing a 429.
+    """
+    
+    WINDOW = 60.0
+    
+    def __init__(self, tpm: int):
+        self.tpm = tpm
+        # [timestamp, tokens] per request, oldest first
+        self.win: Deque[List[float]] = deque()
+        self._lock = threading.Lock()
+    
+    def _expire(self, now: float) -> None:
+        while self.win and self.win[0][0] <= now - self.WINDOW:
+            self.win.popleft()
+    
+    def available(self) -> int:
+        """Tokens left in the current window."""
+        with self._lock:
+            self._expire(time.monotonic())
+            return self.tpm - int(sum(tokens for _, tokens in self.win))
+    
+    def reserve(self, tokens: int) -> Tuple[float, Optional[List[float]]]:
+        """
+        Try to reserve tokens for a request.
+        
+        A request larger than the whole budget is let through once the
+        window is empty, so it can't wait forever.
+        
+        Returns:
+            (0, reservation) if the tokens fit, else (seconds to wait, None)
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            used = sum(t for _, t in self.win)
+            if not self.win or used + tokens <= self.tpm:
+                entry = [now, float(tokens)]
+                self.win.append(entry)
+                return 0.0, entry
+            return self.win[0][0] + self.WINDOW - now, None
+    
+    def record(self, entry: List[float], tokens: int) -> None:
+        """Replace a reservation's estimate with the tokens actually used."""
+        with self._lock:
+            entry[1] = float(tokens)
+
+
+def _shared_budget(api_key: str, tpm: int) -> _Budget:
+    """
+    Return the token budget shared by every client using an API key.
+    
+    If clients on the same key ask for different limits, the lowest wins.
+    """
+    budget = _BUDGETS.setdefault(api_key, _Budget(tpm))
+    with budget._lock:
+        budget.tpm = min(budget.tpm, tpm)
+    return budget
+
+
+class ResponseCache:
+    """
+    In-process LRU cache of Claude responses.
+    
+    Entries are keyed on a hash of everything that determines the response
+    (model, system prompt, message, sampling parameters). If an embedding
+    function is supplied, a miss on the exact key falls back to a flat
+    cosine-similarity scan over cached messages sharing the same model and
+    parameters, so near-duplicate prompts can also be served locally.
+    """
+    
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        embed_fn: Optional[Callable[[str], Sequence[float]]] = None,
+        similarity_threshold: float = 0.97,
+    ):
+        """
+        Initialize the cache.
+        
+        Args:
+            max_entries: Maximum number of cached responses before LRU eviction
+            embed_fn: Optional function mapping text to an embedding vector
+            similarity_threshold: Minimum cosine similarity for a fuzzy hit
+        """
+        self.max_entries = max_entries
+        self.embed_fn = embed_fn
+        self.similarity_threshold = similarity_threshold
+        # key -> (context key, normalized embedding or None, response)
+        self._entries: "OrderedDict[bytes, Tuple[bytes, Optional[List[float]], str]]" = OrderedDict()
+    
+    @staticmethod
+    def _digest(*parts: Any) -> bytes:
+        return hashlib.blake2b("\x00".join(map(str, parts)).encode()).digest()
+    
+    def _embed(self, message: str) -> Optional[List[float]]:
+        if self.embed_fn is None:
+            return None
+        vector = list(self.embed_fn(message))
+        norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+        return [x / norm for x in vector]
+    
+    def get(self, context: Tuple[Any, ...], message: str) -> Optional[str]:
+        """
+        Look up a cached response.
+        
+        Args:
+            context: Everything besides the message that affects the response
+            message: User message
+            
+        Returns:
+            The cached response text, or None on a miss
+        """
+        context_key = self._digest(*context)
+        key = self._digest(context_key, message)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            return entry[2]
+        
+        query = self._embed(message)
+        if query is None:
+            return None
+        best_key, best_score = None, self.similarity_threshold
+        for candidate_key, (candidate_context, vector, _) in self._entries.items():
+            if candidate_context != context_key or vector is None:
+                continue
+            score = sum(a * b for a, b in zip(query, vector))
+            if score >= best_score:
+                best_key, best_score = candidate_key, score
+        if best_key is None:
+            return None
+        self._entries.move_to_end(best_key)
+        return self._entries[best_key][2]
+    
+    def put(self, context: Tuple[Any, ...], message: str, response: str) -> None:
+        """
+        Store a response, evicting the least recently used entry if full.
+        
+        Args:
+            context: Everything besides the message that affects the response
+            message: User message
+            response: Claude's response text
+        """
+        context_key = self._digest(*context)
+        key = self._digest(context_key, message)
+        self._entries[key] = (context_key, self._embed(message), response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    def clear(self) -> None:
+        """Remove all cached responses."""
+        self._entries.clear()
+
+
+def _freeze(value: Any) -> Any:
+    """Recursively turn dicts into read-only mappings and lists into tuples."""
+    if isinstance(value, Mapping):
+        return MappingProxyType({k: _freeze(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+class Conversation:
+    """
+    Incrementally built message history for multi-turn chats.
+    
+    The serialized payload is memoized and only rebuilt after the
+    conversation changes, so an agent loop doesn't rebuild the whole
+    history on every turn. Turns are stored as read-only copies, so
+    neither the caller's input nor a returned payload can be used to
+    change the history behind the conversation's back.
+    """
+    
+    __slots__ = ("_msgs", "_cached_payload", "_dirty")
+    
+    def __init__(self, messages: Optional[Sequence[Mapping[str, Any]]] = None):
+        """
+        Initialize the conversation.
+        
+        Args:
+            messages: Optional initial message dicts with 'role' and 'content' keys
+        """
+        self._msgs: List[Mapping[str, Any]] = [_freeze(m) for m in messages or ()]
+        self._cached_payload: Tuple[Mapping[str, Any], ...] = ()
+        self._dirty = True
+    
+    def append(self, role: str, content: Any) -> None:
+        """
+        Add a turn to the conversation.
+        
+        Args:
+            role: 'user' or 'assistant'
+            content: Message text or list of content blocks
+        """
+        self._msgs.append(_freeze({"role": role, "content": content}))
+        self._dirty = True
+    
+    def payload(self) -> Tuple[Mapping[str, Any], ...]:
+        """
+        Get the messages in the form expected by the API.
+        
+        Returns:
+            Tuple of read-only message mappings, reused until the
+            conversation changes
+        """
+        if self._dirty:
+            self._cached_payload = tuple(self._msgs)
+            self._dirty = False
+        return self._cached_payload
+    
+    def __len__(self) -> int:
+        return len(self._msgs)
 
 
 class ClaudeClient:
     """Client for interacting with Claude API."""
     
-    def __init__(self, api_key: Optional[str] = None):
+    AVAILABLE_MODELS: Tuple[str, ...] = (
+        "claude-3-5-sonnet-20241022",
+        "claude-3-5-haiku-20241022",
+        "claude-3-opus-20240229",
+        "claude-3-sonnet-20240229",
+        "claude-3-haiku-20240307",
+    )
+    
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        response_cache: Optional[ResponseCache] = None,
+        max_retries: int = 5,
+        tokens_per_minute: Optional[int] = None,
+    ):
         """
         Initialize Claude client.
         
         Args:
             api_key: Anthropic API key. If not provided, will use ANTHROPIC_API_KEY env var.
+            response_cache: Cache for deterministic (temperature=0) chat responses.
+                Defaults to an exact-match ResponseCache.
+            max_retries: Retries for rate-limited, 5xx or dropped requests
+            tokens_per_minute: Optional TPM limit; requests that would exceed it
+                wait for the rolling one-minute window instead of hitting a 429.
+                The budget is shared by all clients using the same API key.
         """
-        self.api_key = api_key or os.getenv("ANTHROPIC_API_KEY")
-        if not self.api_key:
+        resolved_key = api_key or os.getenv("ANTHROPIC_API_KEY")
+        if not resolved_key:
             raise ValueError(
                 "API key required. Set ANTHROPIC_API_KEY environment variable "
                 "or pass api_key parameter."
             )
-        self.client = Anthropic(api_key=self.api_key)
+        self.api_key: str = resolved_key
+        self.client = _shared_client(self.api_key)
+        self.response_cache = response_cache if response_cache is not None else ResponseCache()
+        self.max_retries = max_retries
+        self._budget = (
+            _shared_budget(self.api_key, tokens_per_minute) if tokens_per_minute else None
+        )
+    
+    @property
+    def aclient(self) -> "AsyncAnthropic":
+        """Async SDK client for the running event loop (only valid inside one)."""
+        return _shared_async_client(self.api_key)
     
     def chat(
         self,
         message: str,
-        model: str = "claude-3-5-sonnet-20241022",
+        model: Optional[str] = None,
         system_prompt: Optional[str] = None,
-        max_tokens: int = 1024,
-        temperature: float = 1.0,
+        max_tokens: Optional[int] = None,
+        temperature: Optional[float] = None,
+        preset: Optional[str] = None,
+        cache_system: bool = True,
+        use_cache: Optional[bool] = None,
         **kwargs
     ) -> str:
         """
@@ -40,79 +628,137 @@ class ClaudeClient:
         
         Args:
             message: User message to send
-            model: Claude model to use (default: claude-3-5-sonnet-20241022)
+            model: Claude model to use (default: from preset)
             system_prompt: Optional system prompt
             max_tokens: Maximum tokens in response
             temperature: Sampling temperature (0.0 to 1.0)
+            preset: "fast", "balanced" or "quality" defaults (default: balanced)
+            cache_system: Mark the system prompt for prompt caching
+            use_cache: Serve repeated prompts from the response cache
+                (default: only when temperature is 0)
             **kwargs: Additional parameters for the API call
             
         Returns:
             Claude's response text
         """
-        messages = [{"role": "user", "content": message}]
-        
-        params = {
-            "model": model,
-            "messages": messages,
-            "max_tokens": max_tokens,
-            "temperature": temperature,
-            **kwargs
-        }
+        _require_message(message)
+        model, max_tokens, temperature = _resolve_preset(
+            preset, model, max_tokens, temperature
+        )
+        params = self._build_params(
+            message, model, system_prompt, max_tokens, temperature, cache_system, kwargs
+        )
         
-        if system_prompt:
-            params["system"] = system_prompt
+        cache_context = self._response_cache_context(
+            model, system_prompt, max_tokens, temperature, use_cache, kwargs
+        )
+        if cache_context is not None:
+            cached = self.response_cache.get(cache_context, message)
+            if cached is not None:
+                return cached
         
-        response = self.client.messages.create(**params)
-        return response.content[0].text
+        response = self._create(params)
+        text = response.content[0].text
+        if cache_context is not None:
+            self.response_cache.put(cache_context, message, text)
+        return text
     
     def chat_stream(
         self,
         message: str,
-        model: str = "claude-3-5-sonnet-20241022",
+        model: Optional[str] = None,
         system_prompt: Optional[str] = None,
-        max_tokens: int = 1024,
-        temperature: float = 1.0,
+        max_tokens: Optional[int] = None,
+        temperature: Optional[float] = None,
+        preset: Optional[str] = None,
+        cache_system: bool = True,
+        min_chunk_chars: int = 64,
+        max_chunk_delay: float = 0.02,
         **kwargs
-    ):
+    ) -> Iterator[str]:
         """
         Send a chat message to Claude and get a streaming response.
         
+        Text deltas are coalesced so consumers write fewer, larger chunks.
+        Pass min_chunk_chars=0 to receive every delta as it arrives.
+        
         Args:
             message: User message to send
-            model: Claude model to use
+            model: Claude model to use (default: from preset)
             system_prompt: Optional system prompt
             max_tokens: Maximum tokens in response
             temperature: Sampling temperature
+            preset: "fast", "balanced" or "quality" defaults (default: balanced)
+            cache_system: Mark the system prompt for prompt caching
+            min_chunk_chars: Characters to buffer before yielding a chunk
+            max_chunk_delay: Seconds after which buffered text is yielded anyway
             **kwargs: Additional parameters
             
         Yields:
             Text chunks from Claude's streaming response
         """
-        messages = [{"role": "user", "content": message}]
-        
-        params = {
-            "model": model,
-            "messages": messages,
-            "max_tokens": max_tokens,
-            "temperature": temperature,
-            "stream": True,
-            **kwargs
-        }
+        _require_message(message)
+        model, max_tokens, temperature = _resolve_preset(
+            preset, model, max_tokens, temperature
+        )
+        params = self._build_params(
+            message, model, system_prompt, max_tokens, temperature, cache_system, kwargs
+        )
         
-        if system_prompt:
-            params["system"] = system_prompt
+        reservation = self._reserve_budget(params)
+        # Opening the stream sends the request, so failures before any
+        # output arrives are retried like any other call.
+        stream = self._call_with_retry(
+            lambda: self.client.messages.stream(**params).__enter__()
+        )
+        with stream:
+            yield from coalesce(stream.text_stream, min_chunk_chars, max_chunk_delay)
+            self._record_usage(reservation, stream.get_final_message())
+    
+    def stream_to(self, message: str, out: Optional[TextIO] = None, **kwargs) -> str:
+        """
+        Stream a response straight to a text stream, flushing once at the end.
         
-        with self.client.messages.stream(**params) as stream:
-            for text in stream.text_stream:
-                yield text
+        Args:
+            message: User message to send
+            out: Stream to write to (default: sys.stdout at call time)
+            **kwargs: Parameters passed through to chat_stream()
+            
+        Returns:
+            Claude's full response text
+        """
+        if out is None:
+            out = sys.stdout
+        binary = getattr(out, "buffer", None)
+        encoding = getattr(out, "encoding", None) or "utf-8"
+        if binary is not None:
+            # Anything already written through the text layer must land first.
+            out.flush()
+        chunks = []
+        for chunk in self.chat_stream(message, **kwargs):
+            chunks.append(chunk)
+            if binary is not None:
+                binary.write(chunk.encode(encoding, errors="replace"))
+            else:
+                out.write(chunk)
+        if binary is not None:
+            binary.flush()
+        else:
+            out.flush()
+        return "".join(chunks)
     
     def chat_with_history(
         self,
-        messages: List[Dict[str, str]],
-        model: str = "claude-3-5-sonnet-20241022",
+        messages: Sequence[Mapping[str, Any]],
+        model: Optional[str] = None,
         system_prompt: Optional[str] = None,
-        max_tokens: int = 1024,
-        temperature: float = 1.0,
+        max_tokens: Optional[int] = None,
+        temperature: Optional[float] = None,
+        preset: Optional[str] = None,
+        cache_system: bool = True,
+        max_context_tokens: Optional[int] = 100_000,
+        keep_first: int = 1,
+        keep_last: int = 6,
         **kwargs
     ) -> str:
         """
@@ -120,15 +766,34 @@ class ClaudeClient:
         
         Args:
             messages: List of message dicts with 'role' and 'content' keys
-            model: Claude model to use
+            model: Claude model to use (default: from preset)
             system_prompt: Optional system prompt
             max_tokens: Maximum tokens in response
             temperature: Sampling temperature
+            preset: "fast", "balanced" or "quality" defaults (default: balanced)
+            cache_system: Mark the system prompt and history prefix for prompt caching
+            max_context_tokens: Estimated token count above which the middle of
+                the conversation is replaced by a summary (None to disable).
+                Each call over the limit costs an extra summary request.
+            keep_first: Messages kept verbatim at the start when summarizing
+            keep_last: Messages kept verbatim at the end when summarizing
             **kwargs: Additional parameters
             
         Returns:
             Claude's response text
         """
+        _require_history(messages)
+        model, max_tokens, temperature = _resolve_preset(
+            preset, model, max_tokens, temperature
+        )
+        if max_context_tokens is not None:
+            messages = self._prune_history(
+                messages, system_prompt, max_context_tokens, keep_first, keep_last
+            )
+        
+        if cache_system:
+            messages = _cache_history(messages)
+        
         params = {
             "model": model,
             "messages": messages,
@@ -138,25 +803,439 @@ class ClaudeClient:
         }
         
         if system_prompt:
-            params["system"] = system_prompt
+            params["system"] = _system_param(system_prompt, cache_system)
         
-        response = self.client.messages.create(**params)
+        response = self._create(params)
         return response.content[0].text
     
-    def get_available_models(self) -> List[str]:
+    def _prune_history(
+        self,
+        messages: Sequence[Mapping[str, Any]],
+        system_prompt: Optional[str],
+        max_context_tokens: int,
+        keep_first: int,
+        keep_last: int,
+    ) -> Sequence[Mapping[str, Any]]:
         """
-        Get list of available Claude models.
+        Summarize the middle of a conversation that has grown too long.
         
-        Returns:
-            List of model names
+        The first keep_first and last keep_last messages are kept verbatim
+        and everything between them is replaced by a single assistant turn
+        containing a summary. Boundaries are nudged so that the summary sits
+        between two user turns and roles keep alternating; the final user
+        turn is always kept so the request never ends on the summary, and
+        the span never separates a tool_use from its tool_result.
+        
+        Each call over the threshold makes a blocking summary request. The
+        summarized span shifts as the conversation grows, so the response
+        cache rarely helps here; callers with long-running sessions should
+        fold the summary back into their history (or a Conversation) rather
+        than re-sending the full list every turn.
         """
+        total = sum(_estimate_tokens(_message_text(m)) for m in messages)
+        if system_prompt:
+            total += _estimate_tokens(system_prompt)
+        if total <= max_context_tokens:
+            return messages
+        
+        start = max(keep_first, 1)
+        if start < len(messages) and messages[start]["role"] != "assistant":
+            start += 1
+        last_user = max(
+            (i for i, m in enumerate(messages) if m["role"] == "user"), default=0
+        )
+        end = min(len(messages) - keep_last, last_user)
+        if end > start and messages[end]["role"] != "user":
+            end -= 1
+        if end > start and _has_tool_result(messages[end]):
+            # Its tool_use would be summarized away, which the API rejects.
+            # Move on to the next plain user turn, or back if there is none.
+            plain = [
+                i for i in range(start + 2, last_user + 1)
+                if messages[i]["role"] == "user" and not _has_tool_result(messages[i])
+            ]
+            end = next((i for i in plain if i > end), plain[-1] if plain else start)
+        if end - start < 2:
+            return messages
+        
+        transcript = "\n".join(
+            f"{m['role']}: {_message_text(m)}" for m in messages[start:end]
+        )
+        summary = self.chat(
+            "Summarize the following conversation in <=300 tokens:\n" + transcript,
+            model=SUMMARY_MODEL,
+            max_tokens=512,
+            temperature=0.0,
+        )
         return [
-            "claude-3-5-sonnet-20241022",
-            "claude-3-5-haiku-20241022",
-            "claude-3-opus-20240229",
-            "claude-3-sonnet-20240229",
-            "claude-3-haiku-20240307",
+            *messages[:start],
+            {"role": "assistant", "content": "[Summary] " + summary},
+            *messages[end:],
         ]
+    
+    def chat_conversation(self, conversation: Conversation, **kwargs) -> str:
+        """
+        Continue a Conversation and record Claude's reply in it.
+        
+        Args:
+            conversation: Conversation ending with a user turn
+            **kwargs: Parameters passed through to chat_with_history()
+            
+        Returns:
+            Claude's response text
+        """
+        reply = self.chat_with_history(conversation.payload(), **kwargs)
+        conversation.append("assistant", reply)
+        return reply
+    
+    async def achat(
+        self,
+        message: str,
+        model: Optional[str] = None,
+        system_prompt: Optional[str] = None,
+        max_tokens: Optional[int] = None,
+        temperature: Optional[float] = None,
+        preset: Optional[str] = None,
+        cache_system: bool = True,
+        use_cache: Optional[bool] = None,
+        **kwargs
+    ) -> str:
+        """
+        Async version of chat(); does not block the event loop.
+        
+        Args:
+            message: User message to send
+            model: Claude model to use (default: from preset)
+            system_prompt: Optional system prompt
+            max_tokens: Maximum tokens in response
+            temperature: Sampling temperature
+            preset: "fast", "balanced" or "quality" defaults (default: balanced)
+            cache_system: Mark the system prompt for prompt caching
+            use_cache: Serve repeated prompts from the response cache
+                (default: only when temperature is 0)
+            **kwargs: Additional parameters for the API call
+            
+        Returns:
+            Claude's response text
+        """
+        _require_message(message)
+        model, max_tokens, temperature = _resolve_preset(
+            preset, model, max_tokens, temperature
+        )
+        params = self._build_params(
+            message, model, system_prompt, max_tokens, temperature, cache_system, kwargs
+        )
+        
+        cache_context = self._response_cache_context(
+            model, system_prompt, max_tokens, temperature, use_cache, kwargs
+        )
+        if cache_context is not None:
+            cached = self.response_cache.get(cache_context, message)
+            if cached is not None:
+                return cached
+        
+        response = await self._acreate(params)
+        text = response.content[0].text
+        if cache_context is not None:
+            self.response_cache.put(cache_context, message, text)
+        return text
+    
+    async def achat_batch(
+        self,
+        prompts: List[str],
+        max_concurrency: int = 5,
+        **kwargs
+    ) -> List[str]:
+        """
+        Send several prompts concurrently and collect the responses.
+        
+        Requests run in parallel, at most max_concurrency in flight at
+        once. Failed requests are retried as in achat().
+        
+        Args:
+            prompts: User messages to send
+            max_concurrency: Maximum number of requests in flight
+            **kwargs: Parameters passed through to achat()
+            
+        Returns:
+            Claude's response texts, in the same order as prompts
+        """
+        sem = asyncio.Semaphore(max_concurrency)
+        
+        async def run(prompt: str) -> str:
+            async with sem:
+                return await self.achat(prompt, **kwargs)
+        
+        return await asyncio.gather(*[run(p) for p in prompts])
+    
+    async def achat_stream(
+        self,
+        message: str,
+        model: Optional[str] = None,
+        system_prompt: Optional[str] = None,
+        max_tokens: Optional[int] = None,
+        temperature: Optional[float] = None,
+        preset: Optional[str] = None,
+        cache_system: bool = True,
+        queue: Optional["asyncio.Queue[Optional[str]]"] = None,
+        **kwargs
+    ) -> AsyncIterator[str]:
+        """
+        Async version of chat_stream(); does not block the event loop.
+        
+        If a queue is given, every text delta is also put on it as it
+        arrives, followed by None once the stream ends (or fails), so a
+        separate consumer such as a TTS or UI task can drain it while the
+        next chunk is being fetched.
+        
+        Args:
+            message: User message to send
+            model: Claude model to use (default: from preset)
+            system_prompt: Optional system prompt
+            max_tokens: Maximum tokens in response
+            temperature: Sampling temperature
+            preset: "fast", "balanced" or "quality" defaults (default: balanced)
+            cache_system: Mark the system prompt for prompt caching
+            queue: Optional queue to publish text deltas to
+            **kwargs: Additional parameters
+            
+        Yields:
+            Text deltas from Claude's streaming response
+        """
+        try:
+            _require_message(message)
+            model, max_tokens, temperature = _resolve_preset(
+                preset, model, max_tokens, temperature
+            )
+            params = self._build_params(
+                message, model, system_prompt, max_tokens, temperature, cache_system, kwargs
+            )
+            reservation = await self._areserve_budget(params)
+            stream = await self._acall_with_retry(
+                lambda: self.aclient.messages.stream(**params).__aenter__()
+            )
+            async with stream:
+                async for text in stream.text_stream:
+                    if queue is not None:
+                        await queue.put(text)
+                    yield text
+                self._record_usage(reservation, await stream.get_final_message())
+        finally:
+            if queue is not None:
+                await queue.put(None)
+    
+    @staticmethod
+    def _build_params(
+        message: str,
+        model: str,
+        system_prompt: Optional[str],
+        max_tokens: int,
+        temperature: float,
+        cache_system: bool,
+        kwargs: Dict[str, Any],
+    ) -> Dict[str, Any]:
+        """Build request parameters for a single user message."""
+        try:
+            base = _base_params(
+                message, system_prompt, max_tokens, temperature, cache_system,
+                frozenset(kwargs.items()),
+            )
+        except TypeError:
+            # Unhashable extra parameters (e.g. tools, metadata) can't be memoized.
+            base = _base_params.__wrapped__(
+                message, system_prompt, max_tokens, temperature, cache_system,
+                kwargs.items(),
+            )
+        params = dict(base)
+        params["model"] = model
+        return params
+    
+    def _create(self, params: Dict[str, Any]) -> Any:
+        """Send a messages.create request within the token budget, with retries."""
+        reservation = self._reserve_budget(params)
+        response = self._call_with_retry(self.client.messages.create, **params)
+        self._record_usage(reservation, response)
+        return response
+    
+    async def _acreate(self, params: Dict[str, Any]) -> Any:
+        """Async version of _create()."""
+        reservation = await self._areserve_budget(params)
+        response = await self._acall_with_retry(self.aclient.messages.create, **params)
+        self._record_usage(reservation, response)
+        return response
+    
+    def _reserve_budget(self, params: Mapping[str, Any]) -> Optional[List[float]]:
+        """Wait until the request fits in the token budget and reserve it."""
+        if self._budget is None:
+            return None
+        tokens = _estimate_request_tokens(params)
+        while True:
+            wait, reservation = self._budget.reserve(tokens)
+            if reservation is not None:
+                return reservation
+            logger.info("Token budget exhausted, waiting %.1fs", wait)
+            time.sleep(wait)
+    
+    async def _areserve_budget(self, params: Mapping[str, Any]) -> Optional[List[float]]:
+        """Async version of _reserve_budget()."""
+        if self._budget is None:
+            return None
+        tokens = _estimate_request_tokens(params)
+        while True:
+            wait, reservation = self._budget.reserve(tokens)
+            if reservation is not None:
+                return reservation
+            logger.info("Token budget exhausted, waiting %.1fs", wait)
+            await asyncio.sleep(wait)
+    
+    def _record_usage(self, reservation: Optional[List[float]], response: Any) -> None:
+        """Log cache usage and charge the real token count to the budget."""
+        _log_cache_usage(response)
+        if reservation is not None and self._budget is not None:
+            usage = response.usage
+            # input_tokens excludes prompt-cache writes and reads, which
+            # still count toward the rate limit.
+            tokens = (
+                usage.input_tokens
+                + usage.output_tokens
+                + (getattr(usage, "cache_creation_input_tokens", None) or 0)
+                + (getattr(usage, "cache_read_input_tokens", None) or 0)
+            )
+            self._budget.record(reservation, tokens)
+    
+    def _call_with_retry(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Call fn, retrying with backoff on rate limits and transient failures."""
+        retryable = _retryable_errors()
+        for attempt in range(self.max_retries + 1):
+            try:
+                return fn(*args, **kwargs)
+            except retryable as e:
+                delay = _retry_delay(e, attempt)
+                if delay is None or attempt == self.max_retries:
+                    raise
+                logger.warning("Claude request failed (%s), retrying in %.1fs", e, delay)
+                time.sleep(delay)
+    
+    async def _acall_with_retry(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Async version of _call_with_retry()."""
+        retryable = _retryable_errors()
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await fn(*args, **kwargs)
+            except retryable as e:
+                delay = _retry_delay(e, attempt)
+                if delay is None or attempt == self.max_retries:
+                    raise
+                logger.warning("Claude request failed (%s), retrying in %.1fs", e, delay)
+                await asyncio.sleep(delay)
+    
+    @staticmethod
+    def _response_cache_context(
+        model: str,
+        system_prompt: Optional[str],
+        max_tokens: int,
+        temperature: float,
+        use_cache: Optional[bool],
+        kwargs: Dict[str, Any],
+    ) -> Optional[Tuple[Any, ...]]:
+        """Return the response-cache context for a call, or None if it shouldn't be cached."""
+        if use_cache is None:
+            use_cache = temperature == 0
+        if not use_cache:
+            return None
+        return (model, system_prompt, max_tokens, temperature, sorted(kwargs.items()))
+    
+    def chat_batch_offline(
+        self,
+        prompts: List[str],
+        model: Optional[str] = None,
+        system_prompt: Optional[str] = None,
+        max_tokens: Optional[int] = None,
+        temperature: Optional[float] = None,
+        preset: Optional[str] = None,
+        cache_system: bool = True,
+        max_wait_s: float = 24 * 60 * 60,
+        poll_interval: float = 5.0,
+        **kwargs
+    ) -> List[Optional[str]]:
+        """
+        Run prompts through the Message Batches API and wait for the results.
+        
+        Batches are processed asynchronously server-side at half the token
+        price and outside the per-request rate limits, which suits offline
+        workloads such as evals. Not for interactive use: a batch can take
+        minutes to hours to finish.
+        
+        Args:
+            prompts: User messages to send
+            model: Claude model to use (default: from preset)
+            system_prompt: Optional system prompt
+            max_tokens: Maximum tokens in each response
+            temperature: Sampling temperature
+            preset: "fast", "balanced" or "quality" defaults (default: balanced)
+            cache_system: Mark the system prompt for prompt caching
+            max_wait_s: Seconds to wait for the batch before giving up
+            poll_interval: Initial seconds between status checks (doubles up to 60s)
+            **kwargs: Additional parameters for each request
+            
+        Returns:
+            Claude's response texts in the same order as prompts, with None
+            for requests that errored, were canceled or expired
+            
+        Raises:
+            TimeoutError: If the batch hasn't ended within max_wait_s
+        """
+        if not prompts:
+            return []
+        for prompt in prompts:
+            _require_message(prompt)
+        model, max_tokens, temperature = _resolve_preset(
+            preset, model, max_tokens, temperature
+        )
+        batches = self.client.messages.batches
+        requests = [
+            {
+                "custom_id": f"r{i}",
+                "params": self._build_params(
+                    prompt, model, system_prompt, max_tokens, temperature,
+                    cache_system, kwargs,
+                ),
+            }
+            for i, prompt in enumerate(prompts)
+        ]
+        batch = self._call_with_retry(batches.create, requests=requests)
+        
+        deadline = time.monotonic() + max_wait_s
+        delay = poll_interval
+        while batch.processing_status != "ended":
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(
+                    f"Batch {batch.id} did not finish within {max_wait_s}s"
+                )
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, MAX_BACKOFF)
+            batch = self._call_with_retry(batches.retrieve, batch.id)
+        
+        results: List[Optional[str]] = [None] * len(prompts)
+        for entry in self._call_with_retry(batches.results, batch.id):
+            if entry.result.type == "succeeded":
+                results[int(entry.custom_id[1:])] = entry.result.message.content[0].text
+            else:
+                logger.warning(
+                    "Batch %s request %s %s", batch.id, entry.custom_id, entry.result.type
+                )
+        return results
+    
+    @classmethod
+    def get_available_models(cls) -> Tuple[str, ...]:
+        """
+        Get list of available Claude models.
+        
+        Returns:
+            Tuple of model names (shared; not copied per call)
+        """
+        return cls.AVAILABLE_MODELS
 
 
 # Example usage
@@ -178,8 +1257,7 @@ if __name__ == "__main__":
         
         # Streaming response
         print("\nStreaming response:")
-        for chunk in client.chat_stream("Tell me a short joke."):
-            print(chunk, end="", flush=True)
+        client.stream_to("Tell me a short joke.")
         print()
         
     except ValueError as e:
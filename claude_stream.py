@@ -0,0 +1,40 @@
+"""
+Streaming helpers for the LuxAI Claude client.
+Kept free of SDK imports and fully typed so setup.py can compile this
+module with mypyc; the per-delta loop below runs once per streamed token.
+"""
+
+import time
+from typing import Iterable, Iterator, List
+
+
+def coalesce(texts: Iterable[str], min_chars: int, max_delay: float) -> Iterator[str]:
+    """
+    Group streamed text deltas into larger chunks.
+    
+    A chunk is emitted once it holds at least min_chars characters or
+    max_delay seconds have passed since the previous chunk, whichever
+    comes first. Whatever is left is emitted when the stream ends.
+    
+    Args:
+        texts: Text deltas as they arrive
+        min_chars: Characters to buffer before emitting a chunk
+        max_delay: Seconds after which buffered text is emitted anyway
+        
+    Yields:
+        Coalesced text chunks
+    """
+    buf: List[str] = []
+    n = 0
+    last = time.monotonic()
+    for text in texts:
+        buf.append(text)
+        n += len(text)
+        now = time.monotonic()
+        if n >= min_chars or now - last >= max_delay:
+            yield "".join(buf)
+            buf.clear()
+            n = 0
+            last = now
+    if buf:
+        yield "".join(buf)
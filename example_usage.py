@@ -4,30 +4,24 @@ Example usage of Claude Client for LuxAI
 
 from claude_client import ClaudeClient
 import os
-from dotenv import load_dotenv
 
-# Load environment variables from .env file
-load_dotenv()
 
-
-def example_basic_chat():
+def example_basic_chat(client: ClaudeClient):
     """Example of basic chat interaction."""
     print("=" * 50)
     print("Example 1: Basic Chat")
     print("=" * 50)
     
-    client = ClaudeClient()
     response = client.chat("What is artificial intelligence?")
     print(f"Response: {response}\n")
 
 
-def example_system_prompt():
+def example_system_prompt(client: ClaudeClient):
     """Example using a system prompt."""
     print("=" * 50)
     print("Example 2: Chat with System Prompt")
     print("=" * 50)
     
-    client = ClaudeClient()
     response = client.chat(
         "Explain quantum computing in simple terms.",
         system_prompt="You are a science educator who explains complex topics in simple, engaging ways."
@@ -35,27 +29,23 @@ def example_system_prompt():
     print(f"Response: {response}\n")
 
 
-def example_streaming():
+def example_streaming(client: ClaudeClient):
     """Example of streaming response."""
     print("=" * 50)
     print("Example 3: Streaming Response")
     print("=" * 50)
     
-    client = ClaudeClient()
-    print("Response (streaming): ", end="", flush=True)
-    for chunk in client.chat_stream("Write a haiku about coding."):
-        print(chunk, end="", flush=True)
+    print("Response (streaming): ", end="")
+    client.stream_to("Write a haiku about coding.")
     print("\n")
 
 
-def example_conversation_history():
+def example_conversation_history(client: ClaudeClient):
     """Example with conversation history."""
     print("=" * 50)
     print("Example 4: Conversation with History")
     print("=" * 50)
     
-    client = ClaudeClient()
-    
     messages = [
         {"role": "user", "content": "My name is Alice."},
         {"role": "assistant", "content": "Nice to meet you, Alice! How can I help you today?"},
@@ -66,13 +56,12 @@ def example_conversation_history():
     print(f"Response: {response}\n")
 
 
-def example_different_models():
+def example_different_models(client: ClaudeClient):
     """Example using different Claude models."""
     print("=" * 50)
     print("Example 5: Using Different Models")
     print("=" * 50)
     
-    client = ClaudeClient()
     models = client.get_available_models()
     
     print("Available models:")
@@ -90,19 +79,28 @@ def example_different_models():
 
 def main():
     """Run all examples."""
+    from dotenv import load_dotenv
+    
+    # Load environment variables from .env file
+    load_dotenv()
+    
     try:
         # Check if API key is set
-        if not os.getenv("ANTHROPIC_API_KEY"):
+        api_key = os.getenv("ANTHROPIC_API_KEY")
+        if not api_key:
             print("Error: ANTHROPIC_API_KEY environment variable not set.")
             print("Please set it in your .env file or export it:")
             print("export ANTHROPIC_API_KEY='your-api-key-here'")
             return
         
-        example_basic_chat()
-        example_system_prompt()
-        example_streaming()
-        example_conversation_history()
-        example_different_models()
+        # One client (and HTTP connection pool) shared by all examples
+        client = ClaudeClient(api_key=api_key)
+        
+        example_basic_chat(client)
+        example_system_prompt(client)
+        example_streaming(client)
+        example_conversation_history(client)
+        example_different_models(client)
         
     except Exception as e:
         print(f"Error: {e}")
@@ -0,0 +1,58 @@
+"""
+Build script for the LuxAI Claude client.
+
+The streaming hot path (claude_stream.py) is compiled to a C extension
+with mypyc, which pyproject.toml pulls into the isolated build
+environment. The extension is optional: if mypyc is unavailable (e.g.
+--no-build-isolation without mypy) or there is no working C compiler,
+the modules are installed as plain Python and behave identically.
+"""
+
+from setuptools import setup
+from setuptools.command.build_ext import build_ext
+from setuptools.errors import CCompilerError, CompileError, ExecError, PlatformError
+
+try:
+    from mypyc.build import mypycify
+except ImportError:
+    ext_modules = []
+else:
+    ext_modules = mypycify(["claude_stream.py"])
+
+BUILD_ERRORS = (CCompilerError, CompileError, ExecError, PlatformError, OSError)
+
+
+class optional_build_ext(build_ext):
+    """build_ext that falls back to the pure-Python module on failure."""
+
+    def run(self):
+        try:
+            super().run()
+        except BUILD_ERRORS as e:
+            self._skip(e)
+
+    def build_extension(self, ext):
+        try:
+            super().build_extension(ext)
+        except BUILD_ERRORS as e:
+            self._skip(e)
+
+    def _skip(self, error):
+        self.warn(f"could not compile claude_stream ({error}); installing pure Python")
+
+
+setup(
+    name="luxai-claude-client",
+    version="0.1.0",
+    description="A wrapper around Anthropic's Claude API for LuxAI",
+    py_modules=["claude_client", "claude_stream"],
+    # Keep in sync with requirements.txt (not shipped in the sdist).
+    install_requires=[
+        "anthropic>=0.40.0,<1.0",
+        "httpx[http2]>=0.23.0",
+        "python-dotenv>=1.0.0",
+    ],
+    ext_modules=ext_modules,
+    cmdclass={"build_ext": optional_build_ext},
+    python_requires=">=3.8",
+)
@@ -0,0 +1,611 @@
+"""
+Unit tests for the stateful helpers in claude_client.
+These run without network access; tests that need the SDK are skipped
+when anthropic is not installed.
+"""
+
+import asyncio
+import contextlib
+import io
+import json
+from types import SimpleNamespace
+from typing import Any, Tuple
+
+import pytest
+
+import claude_client
+import claude_stream
+from claude_client import ClaudeClient, Conversation, ResponseCache, _Budget
+
+
+class FakeClock:
+    """Stand-in for time.monotonic that only moves when told to."""
+
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(claude_client.time, "monotonic", fake)
+    return fake
+
+
+# _Budget
+
+def test_budget_reserves_within_limit(clock):
+    budget = _Budget(100)
+    wait, entry = budget.reserve(60)
+    assert wait == 0.0 and entry is not None
+    assert budget.available() == 40
+
+
+def test_budget_waits_until_oldest_entry_expires(clock):
+    budget = _Budget(100)
+    budget.reserve(60)
+    clock.now += 15
+    wait, entry = budget.reserve(60)
+    assert entry is None
+    assert wait == pytest.approx(45.0)
+
+    clock.now += 45
+    wait, entry = budget.reserve(60)
+    assert wait == 0.0 and entry is not None
+
+
+def test_budget_lets_oversized_request_through_when_empty(clock):
+    budget = _Budget(100)
+    wait, entry = budget.reserve(500)
+    assert wait == 0.0 and entry is not None
+    assert budget.reserve(1)[1] is None
+
+
+def test_budget_record_replaces_estimate(clock):
+    budget = _Budget(100)
+    _, entry = budget.reserve(90)
+    budget.record(entry, 10)
+    assert budget.available() == 90
+
+
+def test_record_usage_counts_prompt_cache_tokens(clock):
+    client = ClaudeClient.__new__(ClaudeClient)
+    client._budget = _Budget(10_000)
+    usage = SimpleNamespace(
+        input_tokens=10, output_tokens=20,
+        cache_creation_input_tokens=3000, cache_read_input_tokens=None,
+    )
+    reservation = client._budget.reserve(5000)[1]
+    client._record_usage(reservation, SimpleNamespace(usage=usage))
+    assert client._budget.available() == 10_000 - 3030
+
+
+def test_budget_shared_per_api_key(monkeypatch):
+    monkeypatch.setattr(claude_client, "_BUDGETS", {})
+    first = claude_client._shared_budget("key-a", 1000)
+    second = claude_client._shared_budget("key-a", 500)
+    other = claude_client._shared_budget("key-b", 500)
+    assert first is second
+    assert first.tpm == 500
+    assert other is not first
+
+
+# _cache_history
+
+def test_cache_history_marks_last_assistant_turn():
+    messages = [
+        {"role": "user", "content": "q0"},
+        {"role": "assistant", "content": "a0"},
+        {"role": "user", "content": "q1"},
+        {"role": "assistant", "content": [{"type": "text", "text": "a1"}]},
+        {"role": "user", "content": "q2"},
+    ]
+    cached = claude_client._cache_history(messages)
+
+    assert cached[3]["content"] == [
+        {"type": "text", "text": "a1", "cache_control": claude_client.EPHEMERAL_CACHE}
+    ]
+    assert [cached[i] for i in (0, 1, 2, 4)] == [messages[i] for i in (0, 1, 2, 4)]
+    assert "cache_control" not in messages[3]["content"][0]
+
+
+def test_cache_history_wraps_string_content():
+    messages = [
+        {"role": "user", "content": "q0"},
+        {"role": "assistant", "content": "a0"},
+        {"role": "user", "content": "q1"},
+    ]
+    cached = claude_client._cache_history(messages)
+    assert cached[1]["content"] == [
+        {"type": "text", "text": "a0", "cache_control": claude_client.EPHEMERAL_CACHE}
+    ]
+    assert messages[1]["content"] == "a0"
+
+
+def test_cache_history_without_assistant_turn_is_unchanged():
+    messages = [{"role": "user", "content": "q0"}]
+    assert claude_client._cache_history(messages) is messages
+
+
+# ResponseCache
+
+CONTEXT: Tuple[Any, ...] = ("model", None, 1024, 0.0, [])
+
+
+def test_cache_exact_hit_and_context_isolation():
+    cache = ResponseCache()
+    cache.put(CONTEXT, "hello", "hi")
+    assert cache.get(CONTEXT, "hello") == "hi"
+    assert cache.get(("other-model",) + CONTEXT[1:], "hello") is None
+    assert cache.get(CONTEXT, "hello!") is None
+
+
+def test_cache_evicts_least_recently_used():
+    cache = ResponseCache(max_entries=2)
+    cache.put(CONTEXT, "a", "A")
+    cache.put(CONTEXT, "b", "B")
+    assert cache.get(CONTEXT, "a") == "A"
+    cache.put(CONTEXT, "c", "C")
+    assert cache.get(CONTEXT, "b") is None
+    assert cache.get(CONTEXT, "a") == "A"
+    assert cache.get(CONTEXT, "c") == "C"
+
+
+def test_cache_fuzzy_hit_above_threshold():
+    def embed(text):
+        return [text.count("a"), text.count("b"), 1.0]
+
+    cache = ResponseCache(embed_fn=embed, similarity_threshold=0.97)
+    cache.put(CONTEXT, "aab", "cached")
+    assert cache.get(CONTEXT, "aba") == "cached"
+    assert cache.get(CONTEXT, "bbbbbb") is None
+    assert cache.get(("other-model",) + CONTEXT[1:], "aba") is None
+
+
+# Conversation
+
+def test_conversation_payload_memoized_until_append():
+    conversation = Conversation([{"role": "user", "content": "hi"}])
+    payload = conversation.payload()
+    assert conversation.payload() is payload
+    conversation.append("assistant", "hello")
+    assert len(conversation.payload()) == 2
+    assert conversation.payload() is not payload
+
+
+def test_conversation_entries_are_read_only_copies():
+    source = [{"role": "user", "content": [{"type": "text", "text": "hi"}]}]
+    conversation = Conversation(source)
+    source[0]["content"][0]["text"] = "changed"
+
+    message = conversation.payload()[0]
+    assert message["content"][0]["text"] == "hi"
+    with pytest.raises(TypeError):
+        message["role"] = "assistant"
+
+
+# coalesce / stream_to
+
+def test_coalesce_groups_by_size_and_flushes_remainder(monkeypatch, clock):
+    monkeypatch.setattr(claude_stream.time, "monotonic", clock)
+    chunks = claude_stream.coalesce(["ab", "cd", "e", "fgh", "i"], 4, 10.0)
+    assert list(chunks) == ["abcd", "efgh", "i"]
+
+
+def test_coalesce_emits_after_max_delay(monkeypatch, clock):
+    monkeypatch.setattr(claude_stream.time, "monotonic", clock)
+
+    def deltas():
+        yield "a"
+        clock.now += 0.5
+        yield "b"
+        yield "c"
+        clock.now += 0.5
+        yield "d"
+
+    assert list(claude_stream.coalesce(deltas(), 100, 0.5)) == ["ab", "cd"]
+
+
+def test_coalesce_zero_min_chars_passes_deltas_through():
+    assert list(claude_stream.coalesce(["a", "b"], 0, 10.0)) == ["a", "b"]
+
+
+def streaming_client(chunks):
+    """ClaudeClient whose chat_stream() yields fixed chunks."""
+    client = ClaudeClient.__new__(ClaudeClient)
+    client.chat_stream = lambda message, **kwargs: iter(chunks)
+    return client
+
+
+def test_stream_to_writes_text_stream_without_buffer():
+    out = io.StringIO()
+    client = streaming_client(["Hel", "lo"])
+    assert client.stream_to("hi", out) == "Hello"
+    assert out.getvalue() == "Hello"
+
+
+def test_stream_to_writes_through_binary_buffer():
+    raw = io.BytesIO()
+    out = io.TextIOWrapper(raw, encoding="utf-8")
+    out.write("> ")
+    client = streaming_client(["caf", "\u00e9"])
+    assert client.stream_to("hi", out) == "caf\u00e9"
+    assert raw.getvalue() == "> caf\u00e9".encode("utf-8")
+
+
+def test_stream_to_defaults_to_current_stdout():
+    out = io.StringIO()
+    client = streaming_client(["Hello"])
+    with contextlib.redirect_stdout(out):
+        client.stream_to("hi")
+    assert out.getvalue() == "Hello"
+
+
+# _retry_delay and retry wiring
+
+@pytest.fixture
+def sdk(monkeypatch):
+    anthropic = pytest.importorskip("anthropic")
+    monkeypatch.setattr(claude_client.random, "random", lambda: 0.0)
+    return anthropic
+
+
+def status_error(sdk, cls, status, headers=None):
+    import httpx
+
+    request = httpx.Request("POST", "https://api.anthropic.com/v1/messages")
+    response = httpx.Response(status, headers=headers or {}, request=request)
+    return cls("error", response=response, body=None)
+
+
+def test_retry_delay_honors_retry_after(sdk):
+    error = status_error(sdk, sdk.RateLimitError, 429, {"retry-after": "7"})
+    assert claude_client._retry_delay(error, 0) == 7.0
+
+
+def test_retry_delay_backs_off_without_retry_after(sdk):
+    error = status_error(sdk, sdk.RateLimitError, 429, {"retry-after": "soon"})
+    assert claude_client._retry_delay(error, 0) == 1.0
+    assert claude_client._retry_delay(error, 3) == 8.0
+    assert claude_client._retry_delay(error, 20) == claude_client.MAX_BACKOFF
+
+
+def test_retry_delay_retries_server_and_connection_errors(sdk):
+    import httpx
+
+    server = status_error(sdk, sdk.InternalServerError, 503)
+    assert claude_client._retry_delay(server, 1) == 2.0
+    request = httpx.Request("POST", "https://api.anthropic.com/v1/messages")
+    assert claude_client._retry_delay(sdk.APIConnectionError(request=request), 0) == 1.0
+
+
+def test_retry_delay_does_not_retry_client_errors(sdk):
+    error = status_error(sdk, sdk.BadRequestError, 400)
+    assert claude_client._retry_delay(error, 0) is None
+    assert claude_client._retry_delay(ValueError("nope"), 0) is None
+
+
+def sse(*deltas):
+    """Server-sent event body for a streamed text response."""
+    message = {
+        "id": "msg", "type": "message", "role": "assistant", "model": "model",
+        "content": [], "stop_reason": None, "stop_sequence": None,
+        "usage": {"input_tokens": 1, "output_tokens": 0},
+    }
+    events = [
+        ("message_start", {"type": "message_start", "message": message}),
+        ("content_block_start", {
+            "type": "content_block_start", "index": 0,
+            "content_block": {"type": "text", "text": ""},
+        }),
+        *[
+            ("content_block_delta", {
+                "type": "content_block_delta", "index": 0,
+                "delta": {"type": "text_delta", "text": text},
+            })
+            for text in deltas
+        ],
+        ("content_block_stop", {"type": "content_block_stop", "index": 0}),
+        ("message_delta", {
+            "type": "message_delta",
+            "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+            "usage": {"output_tokens": len(deltas)},
+        }),
+        ("message_stop", {"type": "message_stop"}),
+    ]
+    return "".join(f"event: {name}\ndata: {json.dumps(data)}\n\n" for name, data in events)
+
+
+@pytest.fixture
+def api(sdk, monkeypatch):
+    """Route the shared SDK clients to a mock transport that rate-limits twice."""
+    import httpx
+
+    state = {"failures": 2, "requests": 0}
+
+    def handler(request):
+        state["requests"] += 1
+        if state["failures"]:
+            state["failures"] -= 1
+            return httpx.Response(
+                429,
+                headers={"retry-after": "0"},
+                json={"type": "error", "error": {"type": "rate_limit_error", "message": "slow"}},
+            )
+        return httpx.Response(
+            200,
+            headers={"content-type": "text/event-stream"},
+            content=sse("Hel", "lo").encode(),
+        )
+
+    async def ahandler(request):
+        return handler(request)
+
+    monkeypatch.setattr(httpx, "HTTPTransport", lambda **kw: httpx.MockTransport(handler))
+    monkeypatch.setattr(httpx, "AsyncHTTPTransport", lambda **kw: httpx.MockTransport(ahandler))
+    monkeypatch.setattr(claude_client, "_CLIENT_CACHE", {})
+    monkeypatch.setattr(
+        claude_client, "_ASYNC_CLIENT_CACHE", claude_client.weakref.WeakKeyDictionary()
+    )
+    return state
+
+
+def test_chat_stream_retries_when_opening_stream(api):
+    client = ClaudeClient(api_key="test-key")
+    assert "".join(client.chat_stream("hi", min_chunk_chars=0)) == "Hello"
+    assert api["requests"] == 3
+
+
+def test_achat_stream_retries_when_opening_stream(api):
+    client = ClaudeClient(api_key="test-key")
+
+    async def collect():
+        return [text async for text in client.achat_stream("hi")]
+
+    assert "".join(asyncio.run(collect())) == "Hello"
+    assert api["requests"] == 3
+
+
+def test_stream_open_gives_up_after_max_retries(sdk, api):
+    client = ClaudeClient(api_key="test-key", max_retries=1)
+    with pytest.raises(sdk.RateLimitError):
+        list(client.chat_stream("hi"))
+    assert api["requests"] == 2
+
+
+# _prune_history
+
+def alternating(n, text="x" * 400):
+    return [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": f"{i}:{text}"}
+        for i in range(n)
+    ]
+
+
+def pruning_client():
+    """ClaudeClient with chat() stubbed out, for exercising _prune_history."""
+    client = ClaudeClient.__new__(ClaudeClient)
+    client.summary_requests = []
+
+    def chat(message, **kwargs):
+        client.summary_requests.append(message)
+        return "S"
+
+    client.chat = chat
+    return client
+
+
+def test_prune_leaves_short_history_alone():
+    client = pruning_client()
+    messages = alternating(21)
+    assert client._prune_history(messages, None, 10 ** 6, 1, 6) is messages
+    assert client.summary_requests == []
+
+
+def test_prune_summarizes_middle_and_keeps_alternation():
+    client = pruning_client()
+    messages = alternating(21)
+    pruned = client._prune_history(messages, None, 100, 1, 6)
+
+    roles = [m["role"] for m in pruned]
+    assert roles == ["user", "assistant"] * 4 + ["user"]
+    assert pruned[0] is messages[0]
+    assert pruned[1]["content"] == "[Summary] S"
+    assert list(pruned[2:]) == messages[-7:]
+    assert len(client.summary_requests) == 1
+
+
+@pytest.mark.parametrize("keep_last", [0, 1, 2])
+def test_prune_always_keeps_final_user_turn(keep_last):
+    client = pruning_client()
+    messages = alternating(21)
+    pruned = client._prune_history(messages, None, 100, 1, keep_last)
+    assert pruned[-1] is messages[-1]
+    assert pruned[-1]["role"] == "user"
+
+
+def test_prune_skips_when_nothing_to_summarize():
+    client = pruning_client()
+    messages = alternating(5)
+    assert client._prune_history(messages, None, 1, 1, 6) is messages
+
+
+def tool_call(tool_id):
+    return {
+        "role": "assistant",
+        "content": [
+            {"type": "tool_use", "id": tool_id, "name": "search", "input": {"q": tool_id}}
+        ],
+    }
+
+
+def tool_result(tool_id):
+    return {
+        "role": "user",
+        "content": [
+            {"type": "tool_result", "tool_use_id": tool_id, "content": "found " + tool_id * 200}
+        ],
+    }
+
+
+def tool_history(final):
+    return [
+        {"role": "user", "content": "q0"},
+        tool_call("t1"), tool_result("t1"),
+        {"role": "assistant", "content": "a1"},
+        {"role": "user", "content": "q1"},
+        tool_call("t2"), tool_result("t2"),
+        tool_call("t3"), tool_result("t3"),
+        tool_call("t4"), tool_result("t4"),
+        *final,
+    ]
+
+
+def assert_tool_pairs_intact(messages):
+    for previous, message in zip(messages, messages[1:]):
+        for block in message["content"]:
+            if isinstance(block, dict) and block["type"] == "tool_result":
+                calls = [b["id"] for b in previous["content"] if b["type"] == "tool_use"]
+                assert block["tool_use_id"] in calls
+
+
+def test_prune_moves_past_tool_results():
+    client = pruning_client()
+    messages = tool_history(
+        [{"role": "assistant", "content": "a4"}, {"role": "user", "content": "q2"}]
+    )
+    pruned = client._prune_history(messages, None, 100, 1, 2)
+
+    assert [m["role"] for m in pruned] == ["user", "assistant", "user"]
+    assert pruned[-1] is messages[-1]
+    assert_tool_pairs_intact(pruned)
+
+
+def test_prune_falls_back_before_trailing_tool_results():
+    client = pruning_client()
+    messages = tool_history([tool_call("t5"), tool_result("t5")])
+    pruned = client._prune_history(messages, None, 100, 1, 2)
+
+    assert pruned[2]["content"] == "q1"
+    assert list(pruned[2:]) == messages[4:]
+    assert_tool_pairs_intact(pruned)
+
+
+def test_prune_leaves_pure_tool_loop_alone():
+    client = pruning_client()
+    messages = [{"role": "user", "content": "x" * 400}]
+    for i in range(6):
+        messages += [tool_call(f"t{i}"), tool_result(f"t{i}")]
+    assert client._prune_history(messages, None, 1, 1, 2) is messages
+
+
+def test_prune_counts_and_transcribes_tool_content():
+    client = pruning_client()
+    messages = tool_history(
+        [{"role": "assistant", "content": "a4"}, {"role": "user", "content": "q2"}]
+    )
+    assert client._prune_history(messages, None, 300, 1, 2) is not messages
+
+    transcript = client.summary_requests[0]
+    assert "found t2t2" in transcript
+    assert 'search({"q": "t3"})' in transcript
+
+
+def test_message_text_handles_frozen_tool_input():
+    conversation = Conversation([tool_call("t1")])
+    assert claude_client._message_text(conversation.payload()[0]) == 'search({"q": "t1"})'
+
+
+# _build_params
+
+def test_build_params_memoizes_across_models():
+    claude_client._base_params.cache_clear()
+    first = ClaudeClient._build_params("hi", "model-a", "sys", 64, 0.5, True, {})
+    second = ClaudeClient._build_params("hi", "model-b", "sys", 64, 0.5, True, {})
+
+    assert claude_client._base_params.cache_info().hits == 1
+    assert (first["model"], second["model"]) == ("model-a", "model-b")
+    assert first["messages"] is second["messages"]
+    assert first["system"][0]["cache_control"] == claude_client.EPHEMERAL_CACHE
+
+    first["max_tokens"] = 1
+    third = ClaudeClient._build_params("hi", "model-a", "sys", 64, 0.5, True, {})
+    assert third["max_tokens"] == 64
+
+
+def test_build_params_falls_back_for_unhashable_kwargs():
+    claude_client._base_params.cache_clear()
+    tools = [{"name": "search", "input_schema": {"type": "object"}}]
+    params = ClaudeClient._build_params(
+        "hi", "model", None, 64, 0.5, True, {"tools": tools, "top_k": 5}
+    )
+
+    assert params["tools"] is tools
+    assert params["top_k"] == 5
+    assert "system" not in params
+    assert claude_client._base_params.cache_info().currsize == 0
+
+
+# _require_message / _require_history
+
+@pytest.mark.parametrize("message", ["", "   ", "\n\t"])
+def test_require_message_rejects_blank(message):
+    with pytest.raises(ValueError):
+        claude_client._require_message(message)
+
+
+def test_require_message_accepts_text():
+    claude_client._require_message(" hi ")
+
+
+@pytest.mark.parametrize("messages", [
+    [],
+    [{"role": "assistant", "content": "hello"}],
+    [{"role": "user", "content": "  "}],
+    [{"role": "user", "content": [{"type": "text", "text": " "}]}],
+])
+def test_require_history_rejects_empty_user_turns(messages):
+    with pytest.raises(ValueError):
+        claude_client._require_history(messages)
+
+
+@pytest.mark.parametrize("content", [
+    "hi",
+    [{"type": "text", "text": "hi"}],
+    [{"type": "image", "source": {"type": "base64", "media_type": "image/png", "data": ""}}],
+    [{"type": "tool_result", "tool_use_id": "t1", "content": ""}],
+])
+def test_require_history_accepts_user_content(content):
+    claude_client._require_history([{"role": "user", "content": content}])
+
+
+def test_empty_message_fails_before_any_request():
+    client = ClaudeClient.__new__(ClaudeClient)
+    with pytest.raises(ValueError):
+        client.chat(" ")
+    with pytest.raises(ValueError):
+        client.chat_with_history([{"role": "assistant", "content": "hello"}])
+
+
+# _resolve_preset
+
+def test_resolve_preset_defaults_to_balanced():
+    balanced = claude_client.PRESETS[claude_client.DEFAULT_PRESET]
+    assert claude_client._resolve_preset(None, None, None, None) == (
+        balanced["model"], balanced["max_tokens"], balanced["temperature"]
+    )
+
+
+def test_resolve_preset_explicit_values_win():
+    fast = claude_client.PRESETS["fast"]
+    assert claude_client._resolve_preset("fast", "my-model", None, 0.0) == (
+        "my-model", fast["max_tokens"], 0.0
+    )
+
+
+def test_resolve_preset_rejects_unknown_name():
+    with pytest.raises(ValueError, match="fast"):
+        claude_client._resolve_preset("turbo", None, None, None)